@@ -5,9 +5,21 @@ Module to detect appropriate project version number from Git.
 from __future__ import print_function
 import os
 import logging
-import re
+import time
 import argparse
-from subprocess import Popen, CalledProcessError, STDOUT, PIPE
+import functools
+from subprocess import Popen, STDOUT, PIPE
+
+try:
+    from subprocess import DEVNULL
+except ImportError:
+    # Python 2 has no DEVNULL, so open it once rather than on every call.
+    DEVNULL = open(os.devnull, 'wb')
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 logger = logging.getLogger(__name__)
 
@@ -15,27 +27,85 @@ DEFAULT_VERSION = 'release-0.0.0-1'
 DEFAULT_STYLE = 'rc'
 __version__ = ''
 
+GIT_DIR = '.git'
+# File inside GIT_DIR used to persist git describe output between runs.
+DESCRIBE_CACHE_FILE = 'mister_bump_cache'
+# Skip fetching from origin if the last fetch was less than this many seconds ago.
+FETCH_TTL = 300
+
+# CI environment variables holding the current branch name, in order of preference.
+BRANCH_ENV_VARS = ('CI_COMMIT_REF_NAME', 'CI_BUILD_REF_NAME', 'GITHUB_HEAD_REF', 'GITHUB_REF_NAME',
+                   'BRANCH_NAME', 'BRANCH')
+
+
+def _hashable(value):
+    """Convert list arguments into tuples so they can be used as a cache key."""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def _memoize(func=None, maxsize=None):
+    """
+    Cache the result of ``func`` for the lifetime of the process.
+
+    Each git helper spawns a subprocess, so repeated calls with the same arguments
+    are answered from the cache instead.  ``functools.lru_cache`` is not used since it
+    is unavailable on Python 2.  If ``maxsize`` is given then the cache is cleared once
+    it holds that many entries, so it can't grow without bound.
+
+    Example:
+        >>> calls = []
+        >>> @_memoize(maxsize=2)
+        ... def double(x):
+        ...     calls.append(x)
+        ...     return x * 2
+        >>> [double(x) for x in (1, 1, 2, 3, 1)]
+        [2, 2, 4, 6, 2]
+        >>> calls
+        [1, 2, 3, 1]
+    """
+    if func is None:
+        return lambda f: _memoize(f, maxsize=maxsize)
+
+    cache = {}
 
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (tuple(_hashable(a) for a in args),
+               tuple(sorted((k, _hashable(v)) for k, v in kwargs.items())))
+        if key not in cache:
+            if maxsize is not None and len(cache) >= maxsize:
+                cache.clear()
+            cache[key] = func(*args, **kwargs)
+        return cache[key]
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+@_memoize
 def git_fetch_origin():
     """Fetch origin from git to make sure other tags are present."""
-    command = ['git', 'fetch', 'origin']
+    command = ['git', '-c', 'protocol.version=2', 'fetch', '--tags', '--prune', 'origin']
     logger.debug('Fetching commit history from git')
 
     logger.debug('Command: %s', ' '.join(command))
 
-    with open(os.devnull, 'w') as devnull:
-        try:
-            # Use Popen for Python2.6 support
-            return Popen(command, stderr=STDOUT, stdout=PIPE).communicate()[0].rstrip().decode('utf-8')
-            # Python2.7 code would be
-            #   return check_output(command, stderr=STDOUT).rstrip().decode('utf-8')
-        except CalledProcessError as e:
-            logger.error('Failed to fetch from origin.')
-            for line in e.output.split('\n'):
-                logger.error(line)
-            return None
+    # Use Popen instead of check_output for Python2.6 support
+    process = Popen(command, stderr=STDOUT, stdout=PIPE)
+    output = process.communicate()[0].rstrip().decode('utf-8')
+
+    if process.returncode:
+        logger.warning('Failed to fetch from origin.')
+        for line in output.split('\n'):
+            logger.debug(line)
+        return None
 
+    return output
 
+
+@_memoize
 def git_describe(options=None, **kwargs):
     """
     Run git describe and return output.
@@ -48,6 +118,13 @@ def git_describe(options=None, **kwargs):
     into the command ``git describe --match a --match b``.
 
     If the ``git describe`` command fails then DEFAULT_VERSION will be returned.
+
+    Output is cached in ``DESCRIBE_CACHE_FILE`` so later runs (for example repeated
+    ``setup.py`` builds) can skip git entirely.  The cache is keyed on the HEAD commit,
+    the state of the tag refs and the command, so it is invalidated when any of those change.
+
+    If pygit2 is installed then simple ``--tags``/``--abbrev``/``--match`` lookups are
+    done in-process via libgit2, rather than by running git.
     """
     command = ['git', 'describe']
 
@@ -65,40 +142,273 @@ def git_describe(options=None, **kwargs):
             command.append('--%s=%s' % (arg, value))
     logger.debug('Command: %s', ' '.join(command))
 
-    with open(os.devnull, 'w') as devnull:
-        try:
+    cache_key = _describe_cache_key(command)
+    describe_output = _read_describe_cache(cache_key)
+
+    if describe_output is None:
+        describe_output = _pygit2_describe(options or [], kwargs)
+
+        if describe_output is None:
             # Use Popen instead of check_output for Python2.6 support
-            describe_output = Popen(command, stderr=devnull, stdout=PIPE).communicate()[0].rstrip().decode('utf-8')
+            describe_output = Popen(command, stderr=DEVNULL, stdout=PIPE).communicate()[0].rstrip().decode('utf-8')
+
+        _write_describe_cache(cache_key, describe_output)
+
+    # If git describe command didn't return anything (for example when no upstream
+    # refs were found) then return the default version.  Otherwise return the command output.
+    if not describe_output:
+        logger.debug('No upstream refs found, so returning default version.')
+        return DEFAULT_VERSION
+
+    return describe_output
+
+
+@_memoize
+def _pygit2_repository():
+    """Return the pygit2 repository for the current directory, or None if unavailable."""
+    if pygit2 is None:
+        return None
+
+    try:
+        return pygit2.Repository('.')
+    except (pygit2.GitError, KeyError):
+        logger.debug('Unable to open repository with pygit2.')
+        return None
+
+
+def _pygit2_describe(options, kwargs):
+    """
+    Run the equivalent of git describe using pygit2.
+
+    Only ``--tags``, ``abbrev`` and ``match`` are supported.  libgit2 accepts a single
+    pattern, so for multiple ``match`` patterns HEAD is described once per pattern and
+    the closest tag is selected, as git does.  Returns None if pygit2 is unavailable or
+    the arguments are not supported, so that the caller can fall back to running git.
+    Returns an empty string if no tag could be found.
+    """
+    repository = _pygit2_repository()
+
+    if repository is None or set(options) - set(['--tags']) or set(kwargs) - set(['abbrev', 'match']):
+        return None
+
+    patterns = kwargs.get('match')
+    if not isinstance(patterns, list):
+        patterns = [patterns]
+
+    describe_kwargs = {}
+
+    if '--tags' in options:
+        describe_kwargs['describe_strategy'] = pygit2.GIT_DESCRIBE_TAGS
+
+    if 'abbrev' in kwargs:
+        describe_kwargs['abbreviated_size'] = int(kwargs['abbrev'])
+
+    logger.debug('Describing HEAD using pygit2')
+
+    candidates = []
+    for pattern in patterns or [None]:
+        try:
+            candidates.append(repository.describe('HEAD', pattern=pattern, **describe_kwargs))
+        except (pygit2.GitError, KeyError):
+            logger.debug('No tag found matching %s', pattern)
+
+    if not candidates:
+        return ''
+
+    return min(candidates, key=_describe_deviation)
+
+
+def _describe_deviation(describe_output):
+    """
+    Return the number of commits since the tag in git describe output.
+
+    Example:
+        >>> _describe_deviation('release-0.5.0-final-459-ge02af')
+        459
+        >>> _describe_deviation('release-0.5.0-final')
+        0
+    """
+    parts = describe_output.rsplit('-', 2)
+
+    if len(parts) == 3 and parts[1].isdigit() and parts[2].startswith('g'):
+        return int(parts[1])
+
+    return 0
+
+
+def _read_git_file(*path):
+    """Return the stripped contents of a file inside GIT_DIR, or None if it can't be read."""
+    try:
+        with open(os.path.join(GIT_DIR, *path)) as git_file:
+            return git_file.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_head_sha():
+    """
+    Return the commit sha of HEAD by reading GIT_DIR directly, without running git.
+
+    Returns None if the sha could not be determined.
+    """
+    head = _read_git_file('HEAD')
+
+    if not head or not head.startswith('ref: '):
+        return head
+
+    ref = head[len('ref: '):]
+    sha = _read_git_file(*ref.split('/'))
+
+    if sha:
+        return sha
+
+    # The ref may have been packed.
+    for line in (_read_git_file('packed-refs') or '').splitlines():
+        if line.endswith(' ' + ref):
+            return line.split(' ', 1)[0]
+
+    return None
+
+
+def get_head_branch():
+    """
+    Return the current branch by reading HEAD from GIT_DIR directly, without running git.
+
+    Like ``git rev-parse --abbrev-ref HEAD``, ``HEAD`` is returned for a detached HEAD.
+    Returns None if HEAD could not be read, or if the repository uses the reftable ref
+    storage format, where HEAD only contains a placeholder.
+    """
+    if os.path.exists(os.path.join(GIT_DIR, 'reftable')):
+        return None
+
+    return _branch_from_head(_read_git_file('HEAD'))
+
+
+def _branch_from_head(head):
+    """
+    Return the branch name from the contents of a HEAD file, or None if it can't be determined.
+
+    Example:
+        >>> _branch_from_head('ref: refs/heads/bugfix-1.2.3')
+        'bugfix-1.2.3'
+        >>> _branch_from_head('8f50e947b530c4ededd7656ab8bf04a0814ed4ad')
+        'HEAD'
+        >>> _branch_from_head('ref: refs/heads/.invalid')
+        >>> _branch_from_head('ref: refs/remotes/origin/master')
+        >>> _branch_from_head(None)
+    """
+    if not head:
+        return None
+
+    # Repositories using reftable storage keep this placeholder in HEAD.
+    if head == 'ref: refs/heads/.invalid':
+        return None
+
+    if head.startswith('ref: refs/heads/'):
+        return head[len('ref: refs/heads/'):]
+    elif head.startswith('ref: '):
+        return None
+
+    return 'HEAD'
+
+
+def _tags_signature():
+    """Return a string that changes whenever tags are added, removed or packed."""
+    mtimes = []
+
+    packed_refs = os.path.join(GIT_DIR, 'packed-refs')
+    if os.path.exists(packed_refs):
+        mtimes.append(os.path.getmtime(packed_refs))
+
+    for dirpath, _, _ in os.walk(os.path.join(GIT_DIR, 'refs', 'tags')):
+        mtimes.append(os.path.getmtime(dirpath))
+
+    return repr(max(mtimes)) if mtimes else ''
+
+
+def _describe_cache_key(command):
+    """Return the cache key for a git describe command, or None if caching isn't possible."""
+    head_sha = get_head_sha()
+
+    if not head_sha:
+        return None
+
+    return '\t'.join([head_sha, _tags_signature(), ' '.join(command)])
 
-            # If git describe command didn't return anything then return the default version.
-            # Otherwise return the command output.
-            if not describe_output:
-                return DEFAULT_VERSION
 
-            return describe_output
+def _read_describe_cache(cache_key):
+    """Return cached git describe output for cache_key, or None on a cache miss."""
+    if not cache_key:
+        return None
+
+    cached = _read_git_file(DESCRIBE_CACHE_FILE)
+
+    if not cached or '\n' not in cached:
+        return None
+
+    cached_key, describe_output = cached.split('\n', 1)
 
-        except CalledProcessError:
-            logger.debug('No upstream refs found, so returning default version.')
-            return DEFAULT_VERSION
+    if cached_key != cache_key:
+        return None
+
+    logger.debug('Using cached git describe output "%s"', describe_output)
+    return describe_output
+
+
+def _write_describe_cache(cache_key, describe_output):
+    """Store git describe output for cache_key, ignoring any errors."""
+    if not cache_key or not describe_output:
+        return
+
+    try:
+        with open(os.path.join(GIT_DIR, DESCRIBE_CACHE_FILE), 'w') as cache_file:
+            cache_file.write('%s\n%s\n' % (cache_key, describe_output))
+    except (IOError, OSError):
+        logger.debug('Unable to write git describe cache.')
 
 
+@_memoize
 def get_git_branch():
     """Return current git branch.
 
-    This will try to use the GitLab CI CI_BUILD_REF_NAME variable, and
-    if that doesn't exist, then use ``git rev-parse`` instead.
+    This will try to use the branch name provided by the CI system (see
+    ``BRANCH_ENV_VARS``), and if none is set, then read ``HEAD`` from GIT_DIR.  If that
+    isn't possible then use pygit2 (if installed) or ``git rev-parse`` instead.
+    ``GITHUB_HEAD_REF`` is checked before ``GITHUB_REF_NAME`` since it holds the
+    source branch for pull request builds.
     """
+    for env_var in BRANCH_ENV_VARS:
+        branch = os.environ.get(env_var)
+        if branch:
+            logger.debug('Using branch from %s environment variable', env_var)
+            break
+    else:
+        branch = get_head_branch()
 
-    try:
-        branch = os.environ['CI_BUILD_REF_NAME']
-    except KeyError:
-        branch = Popen(['git rev-parse --abrev-ref HEAD'],
-                       shell=True, stdout=PIPE).communicate()[0].rstrip().decode('utf-8')
+        if branch is None:
+            branch = _pygit2_branch()
+
+        if branch is None:
+            branch = Popen(['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+                           stdout=PIPE).communicate()[0].rstrip().decode('utf-8')
 
     logger.debug('Current git branch is %s', branch)
     return branch
 
 
+def _pygit2_branch():
+    """Return current git branch using pygit2, or None if unavailable."""
+    repository = _pygit2_repository()
+
+    if repository is None:
+        return None
+
+    try:
+        return repository.head.shorthand
+    except pygit2.GitError:
+        return None
+
+
 def is_bugfix_branch(branch_name, prefix=''):
     """
     Return True if current branch is bugfix branch.
@@ -129,7 +439,14 @@ def is_bugfix_branch(branch_name, prefix=''):
         >>> is_bugfix_branch('fred/bugfix-0.1.0', prefix='fred/')
         True
     """
-    result = re.match(r'^%sbugfix-[0-9]+\.[0-9]+\.[0-9]+$' % prefix, branch_name) is not None
+    prefix = prefix or ''
+    result = False
+
+    if branch_name.startswith(prefix):
+        rest = branch_name[len(prefix):]
+        if rest.startswith('bugfix-'):
+            numbers = rest[len('bugfix-'):].split('.')
+            result = len(numbers) == 3 and all(n.isdigit() for n in numbers)
 
     logger.debug('Current branch is bugfix? %s', str(result))
 
@@ -173,32 +490,63 @@ def parse_version(version, prefix=''):
         True
 
     """
+    # Copy the cached dict so callers are free to modify the result.
+    return dict(_parse_version_cached(version, prefix))
+
+
+@_memoize(maxsize=128)
+def _parse_version_cached(version, prefix):
+    """Split the version string into components, caching the result for each version and prefix."""
     # Strip off the prefix
-    if prefix:
+    if prefix and version.startswith(prefix):
         logger.debug('Stripping prefix "%s" from "%s".', prefix, version)
-        version = re.sub(r'^%s' % prefix, '', version)
+        version = version[len(prefix):]
         logger.debug('New version is "%s".', version)
 
-    # Split the version string up on . and - characters.
-    parts = re.split(r'[-.]', version)
+    return _parse_version_fast(version)
 
-    # Extend list in case portions are missing.
-    parts.extend([''] * (6 - len(parts)))
 
-    parts_dict = {'type': parts[0],
-                  'major': parts[1],
-                  'minor': parts[2],
-                  'bugfix': parts[3],
-                  'deviation': parts[4],
-                  'hash': parts[5]
-                  }
+def _parse_version_fast(version):
+    """
+    Split an unprefixed version string into components in a single pass.
 
-    if parts_dict['deviation'] == 'final':
-        parts_dict['deviation'] = parts_dict['hash']
-        parts_dict['hash'] = ''
-        parts_dict['type'] = 'final'
+    The string is split on ``-`` into type, version number and the remaining
+    ``deviation-hash`` part, and only the version number is split on ``.``.  A
+    ``final`` marker may follow the version number with either a ``.`` or a ``-``.
 
-    return parts_dict
+    Example:
+        >>> _parse_version_fast('release-0.5.0.final-459') == {'deviation': '459', 'major': '0', 'hash': '',
+        ...     'bugfix': '0', 'type': 'final', 'minor': '5'}
+        True
+        >>> _parse_version_fast('release-0.5.0-final-459-ge02af') == {'deviation': '459', 'major': '0',
+        ...     'hash': 'ge02af', 'bugfix': '0', 'type': 'final', 'minor': '5'}
+        True
+        >>> _parse_version_fast('blahblahblah') == {'deviation': '', 'major': '', 'hash': '',
+        ...     'bugfix': '', 'type': 'blahblahblah', 'minor': ''}
+        True
+    """
+    segments = version.split('-', 2)
+    segments.extend([''] * (3 - len(segments)))
+    version_type, number, remainder = segments
+
+    numbers = number.split('.', 3)
+    numbers.extend([''] * (4 - len(numbers)))
+
+    if numbers[3] == 'final':
+        version_type = 'final'
+    elif remainder == 'final' or remainder.startswith('final-'):
+        version_type = 'final'
+        remainder = remainder[len('final-'):]
+
+    deviation, _, commit_hash = remainder.partition('-')
+
+    return {'type': version_type,
+            'major': numbers[0],
+            'minor': numbers[1],
+            'bugfix': numbers[2],
+            'deviation': deviation,
+            'hash': commit_hash
+            }
 
 
 def log_version_details(version_dict):
@@ -243,13 +591,7 @@ def format_version(version, style='rc'):
     if not version['deviation']:
         style = ''
 
-    version_str = "{major}.{minor}.{bugfix}{suffix}{deviation}".format(
-        major=version['major'],
-        minor=version['minor'],
-        bugfix=version['bugfix'],
-        suffix=style,
-        deviation=version['deviation']
-    )
+    version_str = version['major'] + '.' + version['minor'] + '.' + version['bugfix'] + style + version['deviation']
 
     # Add final suffix for final releases.
     if version['type'] == 'final' and not version['deviation']:
@@ -288,21 +630,44 @@ def get_increment_type(version, prefix=''):
         >>> get_increment_type('blahblahblah')
         >>> get_increment_type('fred/release-0.5.0-459-ge02af', prefix='fred/')
         'minor'
+        >>> get_increment_type('fred/bugfix-0.5.0-459-ge02af', prefix='fred/')
+        'bugfix'
 
     """
-    version_dict = parse_version(version, prefix=prefix)
+    return get_increment_type_from_dict(parse_version(version, prefix=prefix))
 
+
+def get_increment_type_from_dict(version_dict):
+    """
+    Return the appropriate increment type based on an already parsed version.
+
+    Args:
+        version_dict(dict): Parsed version number, as returned by parse_version function.
+
+    Returns:
+        str: Type of version increment to be performed (``major``, ``minor``, ``bugfix``).
+
+    Example:
+
+        >>> get_increment_type_from_dict({'type': 'final', 'major': '1', 'minor': '2', 'bugfix': '3',
+        ...                               'deviation': '459', 'hash': ''})
+        'major'
+        >>> get_increment_type_from_dict({'type': 'bugfix', 'major': '1', 'minor': '2', 'bugfix': '3',
+        ...                               'deviation': '459', 'hash': 'ge02af'})
+        'bugfix'
+        >>> get_increment_type_from_dict({'type': 'release', 'major': '1', 'minor': '2', 'bugfix': '3',
+        ...                               'deviation': '', 'hash': ''})
+
+    """
     # If there is no deviation from the previous release then this IS the release.
     if not version_dict['deviation']:
         logger.debug('There is no deviation from %s %s.%s.%s.  No increment will be performed.',
                      version_dict['type'], version_dict['major'], version_dict['minor'], version_dict['bugfix'])
         return None
 
-    if re.match(r'.*[.-]final-?', version):
+    if version_dict['type'] == 'final':
         return 'major'
-    elif re.match(r'^release-.*', version):
-        return 'minor'
-    elif re.match(r'^bugfix-.*', version):
+    elif version_dict['type'] == 'bugfix':
         return 'bugfix'
 
     return 'minor'
@@ -312,6 +677,8 @@ def increment_version(version, increment):
     """
     Increment version number by increment.
 
+    The version passed in is not modified; a new dict is returned.
+
     Args:
         version(dict): Parsed version number, as returned by parse_version function.
         increment(str, optional): Type of version increment to be performed (``major``, ``minor``, ``bugfix``).
@@ -333,24 +700,32 @@ def increment_version(version, increment):
         ...                    'deviation': '459', 'hash': 'ge02af'}, None) == {'deviation': '459', 'major': '1',
         ...                        'hash': 'ge02af', 'bugfix': '3', 'type': 'release', 'minor': '2'}
         True
+        >>> version = {'type': 'release', 'major': '1', 'minor': '2', 'bugfix': '3', 'deviation': '459', 'hash': ''}
+        >>> increment_version(version, 'minor')['minor'], version['minor']
+        ('3', '2')
+        >>> increment_version(version, None) is version
+        False
 
     """
     if not increment:
         logger.debug('No increment to be done.')
-        return version
+        return dict(version)
 
     logger.debug('Incrementing with %s version increment.', increment.upper())
 
+    # Work on a copy so the caller's dict (which may be cached) is left untouched.
+    new_version = dict(version)
+
     if increment == 'major':
-        version['major'] = str(int(version['major']) + 1)
-        version['minor'] = version['bugfix'] = '0'
+        new_version['major'] = str(int(version['major']) + 1)
+        new_version['minor'] = new_version['bugfix'] = '0'
     elif increment == 'minor':
-        version['minor'] = str(int(version['minor']) + 1)
-        version['bugfix'] = '0'
+        new_version['minor'] = str(int(version['minor']) + 1)
+        new_version['bugfix'] = '0'
     elif increment == 'bugfix':
-        version['bugfix'] = str(int(version['bugfix']) + 1)
+        new_version['bugfix'] = str(int(version['bugfix']) + 1)
 
-    return version
+    return new_version
 
 
 def parse_args():
@@ -365,6 +740,8 @@ def parse_args():
                         ' Must be in the format "release-0.0.0-000-aaaaaa".')
     parser.add_argument('-n', '--no-increment', action='store_true',
                         help='Do not increment version number.')
+    parser.add_argument('--no-fetch', action='store_true',
+                        help='Do not fetch tags from origin before detecting the version.')
     parser.add_argument('-p', '--prefix', type=str, default=None,
                         help='Optionally specify a prefix that you expect to appear before the '
                              '"release-X.X.X" tag. For example if your tag was "fred/release-0.1.0"'
@@ -396,42 +773,87 @@ def get_git_version(tags=None, prefix=None):
 
     logger.debug('Searching for the following tags: %s', ', '.join(tags))
 
-    logger.debug('Fetching all candidate upstream versions')
+    logger.debug('Fetching closest upstream version')
 
-    candidates = [git_describe(options='--tags', abbrev=4, match=t) for t in tags]
+    # git describe accepts multiple --match arguments and returns the closest
+    # matching tag, so a single call replaces one call per tag.  The long format is
+    # kept (rather than --abbrev=0) because the deviation count is needed for the
+    # version suffix, and getting it separately would take a second git call.
+    selected_version = git_describe(options='--tags', abbrev=4, match=tags)
 
-    logger.debug('Candidate versions: %s' % ', '.join(candidates))
+    # Parsing is only needed for the debug output, so skip it otherwise.
+    if logger.isEnabledFor(logging.DEBUG):
+        log_version_details(parse_version(selected_version, prefix=prefix))
 
-    # Take the candidates list of strings and turn into a list
-    # containing version string and parsed dict.
-    candidates = [[c, parse_version(c, prefix=prefix)] for c in candidates]
+    # If the selected version is a release, get current branch, and check whether we are on bugfix.
+    # If so, then we will hack the selected version to be a 'bugfix' rather than 'release'.
+    # Other versions can't be rewritten, so there is no need to look up the branch.
+    release_tag = (prefix or '') + 'release-'
+    if selected_version.startswith(release_tag) and is_bugfix_branch(get_git_branch(), prefix=prefix):
+        selected_version = selected_version.replace(release_tag, (prefix or '') + 'bugfix-', 1)
 
-    selected_version = None
+    logger.debug('Version detected as "%s"', selected_version)
 
-    for candidate in candidates:
+    return selected_version
 
-        logger.debug('Comparing candidate %s', candidate[0])
-        log_version_details(candidate[1])
 
-        if not selected_version:
-            selected_version = candidate
-        elif int(candidate[1]['deviation']) < int(selected_version[1]['deviation']):
-            selected_version = candidate
+def fetch_required():
+    """
+    Return True if tags need to be fetched from origin.
+
+    A fetch is skipped when running in CI on a full (non-shallow) checkout, since the
+    CI system will already have fetched the history, or when ``FETCH_HEAD`` shows that
+    a fetch happened less than ``FETCH_TTL`` seconds ago.  Running in CI is detected by
+    the ``CI`` environment variable being set to ``true`` or ``1`` (case insensitive);
+    any other value, such as ``false`` or ``0``, is treated as not running in CI.  The CI
+    shortcut is only taken when GIT_DIR is a directory in the current working directory.
+    """
+    # Only trust the shallow check when GIT_DIR is a real directory; when not run from the
+    # repository root, or in a worktree, the shallow marker can't be seen so always fetch.
+    if (os.environ.get('CI', '').lower() in ('true', '1') and os.path.isdir(GIT_DIR) and
+            not os.path.exists(os.path.join(GIT_DIR, 'shallow'))):
+        logger.debug('Running in CI with a full checkout, so no fetch is required.')
+        return False
 
-    # Get current branch, and check whether we are on bugfix.
-    # If so, then we will hack the selected version to be a 'bugfix' rather than 'release'.
-    if is_bugfix_branch(get_git_branch(), prefix=prefix):
-        # TODO: Decide whether we need to include prefix in the following sub call.
-        selected_version[0] = re.sub('^release', 'bugfix', selected_version[0], count=1)
+    try:
+        fetch_age = time.time() - os.path.getmtime(os.path.join(GIT_DIR, 'FETCH_HEAD'))
+    except OSError:
+        return True
 
-    # The selected candidate version string will be the first part of the tuple,
-    # so return that.
-    logger.debug('Version detected as "%s"', selected_version[0])
+    if fetch_age < FETCH_TTL:
+        logger.debug('Last fetch was %d seconds ago, so no fetch is required.', fetch_age)
+        return False
 
-    return selected_version[0]
+    return True
 
 
-def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None):
+def _one_shot_version(prefix=None, no_fetch=False):
+    """
+    Fetch tags from origin and return the current version from git.
+
+    At most two git processes are started: one ``git fetch --tags`` and a single
+    ``git describe`` matching all tag patterns (previously one describe was run
+    per tag pattern, plus a separate fetch).  Fewer are started when the fetch is
+    skipped (``no_fetch`` or ``fetch_required`` returns False), and when the describe
+    output is read from ``DESCRIBE_CACHE_FILE`` or produced in-process by pygit2.
+
+    Args:
+        prefix(str, optional): Specify a prefix that you expect to appear before the
+            "release-X.X.X" tag.
+        no_fetch(bool): Do not fetch from origin, only use tags already present locally.
+
+    Returns:
+        str: Unparsed version string.
+    """
+    if no_fetch:
+        logger.debug('No fetch option is set so tags will not be fetched from origin.')
+    elif fetch_required():
+        git_fetch_origin()
+
+    return get_git_version(prefix=prefix)
+
+
+def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None, no_fetch=False):
     """
     Return bumped version.
 
@@ -443,6 +865,7 @@ def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None):
             current git version, and reformat it.
         prefix(str, optional): Specify a prefix that you expect to appear before the
             "release-X.X.X" tag.
+        no_fetch(bool): Do not fetch from origin before reading the version from git.
 
     Returns:
         str: Bumped version number in simplified output format (see examples).
@@ -521,14 +944,50 @@ def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None):
 
     """
     # Check for override
-    # If there was a command line argument then we assume it is a version override.
+    # If there was a command line argument then we assume it is a version override,
+    # and git does not need to be consulted at all.
     if override:
-        git_version = override
-        logger.debug('Using override version "%s"', git_version)
-    else:
-        git_fetch_origin()
-        git_version = get_git_version(prefix=prefix)
+        logger.debug('Using override version "%s"', override)
+        return _bump_pure(override, style=style, no_increment=no_increment, prefix=prefix)
 
+    git_version = _one_shot_version(prefix=prefix, no_fetch=no_fetch)
+
+    return _bump_pure(git_version, style=style, no_increment=no_increment, prefix=prefix)
+
+
+def bump_no_network(**kwargs):
+    """
+    Return bumped version without fetching from origin.
+
+    Only tags already present in the local repository are used.  This is intended for
+    build-time use (for example in ``setup.py``), where pip may build in an isolated
+    environment with no network access, or the checkout is already complete.
+
+    Accepts the same arguments as ``bump`` (apart from ``no_fetch``).
+
+    Example:
+
+        >>> bump_no_network(override='release-1.2.0-456-aaaaa')
+        '1.3.0rc456'
+
+    """
+    return bump(no_fetch=True, **kwargs)
+
+
+def _bump_pure(git_version, style=DEFAULT_STYLE, no_increment=False, prefix=None):
+    """
+    Return bumped version for an unformatted version string, without calling git.
+
+    Args:
+        git_version(str): Unformatted version number, as returned by git_describe function.
+        style(str): Style of suffix. Valid values ``.dev``, ``rc``.
+        no_increment(bool): Do not actually bump the version, just reformat it.
+        prefix(str, optional): Specify a prefix that you expect to appear before the
+            "release-X.X.X" tag.
+
+    Returns:
+        str: Bumped version number in simplified output format.
+    """
     # Parse the version number into parts
     version_dict = parse_version(git_version, prefix=prefix)
 
@@ -536,7 +995,7 @@ def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None):
     if not no_increment:
 
         # Detect the increment type, based on previous tag
-        increment_type = get_increment_type(git_version, prefix=prefix)
+        increment_type = get_increment_type_from_dict(version_dict)
 
         # Increment the version number based on increment type
         version_dict = increment_version(version_dict, increment_type)
@@ -545,10 +1004,7 @@ def bump(style=DEFAULT_STYLE, override=None, no_increment=False, prefix=None):
         logger.debug('No increment option is set to no increment will occur.')
 
     # Format the version number
-    formatted_version = format_version(version_dict, style=style)
-
-    # Output the number
-    return formatted_version
+    return format_version(version_dict, style=style)
 
 
 def test():
@@ -573,7 +1029,7 @@ def main():
                         datefmt='%I:%M:%S')
 
     print(bump(style=args.style, override=args.override, no_increment=args.no_increment,
-               prefix=args.prefix))
+               prefix=args.prefix, no_fetch=args.no_fetch))
 
 
 if __name__ == '__main__':
@@ -27,7 +27,7 @@ if errors:
                      ', '.join([e.message for e in errors]))
 
 # Get version number
-package_version = mister_bump.bump(style='rc')
+package_version = mister_bump.bump_no_network(style='rc')
 
 # Update __version__ variable inside module
 set_module_version('mister_bump.py', package_version)
@@ -43,6 +43,9 @@ setup(
     setup_requires=['setuptools', 'm2r'],
     tests_require=[],
     install_requires=[],
+    extras_require={
+        'pygit2': ['pygit2'],
+    },
     data_files=[],
     options={
         'bdist_wheel': {'universal': True}